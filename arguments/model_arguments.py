@@ -43,6 +43,16 @@ class ModelArguments:
     use_pretrained_model: bool = field(
         default=True, metadata={"help": "If True uses a pretrained model."},
     )
+    compile_segment_encoder: bool = field(
+        default=False,
+        metadata={"help": "If True compiles the segment encoder of the hierarchical models with torch.compile "
+                          "(requires PyTorch >= 2.0). Single-device only, DataParallel replicas run eagerly."},
+    )
+    autocast_bf16: bool = field(
+        default=False,
+        metadata={"help": "If True runs the inner and segment encoders of the hierarchical models under bfloat16 "
+                          "autocast. Unlike --bf16, the classification head and loss stay in full precision."},
+    )
     test_languages: str = field(
         default=None, metadata={
             "help": "Test languages. Also train languages if `train_languages` is set to None."
@@ -1,4 +1,5 @@
-import pandas as pd
+import csv
+import itertools
 
 # TODO implement baselines with BiLSTM, bow, tf-idf
 # TODO experiment with randomly initialized transformer
@@ -22,11 +23,9 @@ types = ['standard', 'hierarchical', 'long']  # longformer
 languages = ['de', 'fr', 'it', 'all']
 train_languages = ['de', 'all']
 
-train_experiments = []
-for lang in languages:
-    for type in types:
-        for model_name in model_names[lang]:
-            experiment = {"model_name": model_name, "type": type, "source_lang": lang, "status": ""}
-            train_experiments.append(experiment)
-df = pd.DataFrame(train_experiments)
-df.to_csv("train_experiments.csv", index=False)
+train_experiments = [{"model_name": model_name, "type": type, "source_lang": lang, "status": ""}
+                     for lang, type in itertools.product(languages, types) for model_name in model_names[lang]]
+with open("train_experiments.csv", "w", newline="") as f:
+    writer = csv.DictWriter(f, fieldnames=["model_name", "type", "source_lang", "status"], lineterminator="\n")
+    writer.writeheader()
+    writer.writerows(train_experiments)
@@ -1,4 +1,6 @@
-import numpy as np
+import contextlib
+import functools
+
 import torch
 from torch import nn
 from torch.nn import MSELoss, CrossEntropyLoss, BCEWithLogitsLoss
@@ -6,9 +8,18 @@ from adapters import ModelWithHeadsAdaptersMixin
 from transformers import BertPreTrainedModel, BertModel, add_start_docstrings
 from transformers.file_utils import add_start_docstrings_to_model_forward, add_code_sample_docstrings
 from transformers.modeling_outputs import SequenceClassifierOutput
+from transformers.utils import logging
 from transformers.models.bert.modeling_bert import BERT_START_DOCSTRING, BERT_INPUTS_DOCSTRING, _TOKENIZER_FOR_DOC, \
     _CHECKPOINT_FOR_DOC, _CONFIG_FOR_DOC
 
+logger = logging.get_logger(__name__)
+
+
+@functools.lru_cache(maxsize=None)
+def compiled(function):
+    """compiles a plain (unbound) function once, so the model itself never references a compiled function"""
+    return torch.compile(function, mode="reduce-overhead", dynamic=True)
+
 
 @add_start_docstrings(
     """
@@ -18,6 +29,8 @@ from transformers.models.bert.modeling_bert import BERT_START_DOCSTRING, BERT_IN
     BERT_START_DOCSTRING,
 )
 class HierBertForSequenceClassification(ModelWithHeadsAdaptersMixin, BertPreTrainedModel):
+    _keys_to_ignore_on_load_unexpected = [r"pooler"]
+
     def __init__(self, config):
         super().__init__(config)
         self.num_labels = config.num_labels
@@ -27,17 +40,19 @@ class HierBertForSequenceClassification(ModelWithHeadsAdaptersMixin, BertPreTrai
         self.segment_encoder_type = config.segment_encoder_type
         self.config = config
 
-        self.bert = BertModel(config)
+        # Only the CLS token of the last hidden state is used per segment, so skip computing the (unused) pooler
+        self.bert = BertModel(config, add_pooling_layer=False)
 
         def sinusoidal_init(num_embeddings: int, embedding_dim: int):
             # keep dim 0 for padding token position encoding zero vector
-            position_enc = np.array([
-                [pos / np.power(10000, 2 * i / embedding_dim) for i in range(embedding_dim)]
-                if pos != 0 else np.zeros(embedding_dim) for pos in range(num_embeddings)])
+            # dims 2i and 2i+1 share the same frequency 1 / 10000^(2i / embedding_dim)
+            positions = torch.arange(num_embeddings, dtype=torch.float32).unsqueeze(1)
+            dims = torch.arange(embedding_dim).unsqueeze(0)
+            position_enc = positions / torch.pow(10000, 2 * (dims // 2) / embedding_dim)
 
-            position_enc[1:, 0::2] = np.sin(position_enc[1:, 0::2])  # dim 2i
-            position_enc[1:, 1::2] = np.cos(position_enc[1:, 1::2])  # dim 2i+1
-            return torch.from_numpy(position_enc).type(torch.FloatTensor)
+            position_enc[1:, 0::2] = torch.sin(position_enc[1:, 0::2])  # dim 2i
+            position_enc[1:, 1::2] = torch.cos(position_enc[1:, 1::2])  # dim 2i+1
+            return position_enc
 
         if self.segment_encoder_type == "lstm":
             # Init segment-wise BiLSTM-based encoder
@@ -46,24 +61,86 @@ class HierBertForSequenceClassification(ModelWithHeadsAdaptersMixin, BertPreTrai
             self.down_project = nn.Linear(in_features=2 * self.hidden_size, out_features=self.hidden_size)
         elif self.segment_encoder_type == "transformer":
             # Init sinusoidal positional embeddings
-            weight = sinusoidal_init(self.max_segments + 1, self.hidden_size)
-            self.seg_pos_embeddings = nn.Embedding(self.max_segments + 1, self.hidden_size,
-                                                   padding_idx=0, _weight=weight)
+            # Fixed table, so a non-persistent buffer: not trained, not saved and not overwritten by init_weights()
+            self.register_buffer("seg_pos_embeddings", sinusoidal_init(self.max_segments + 1, self.hidden_size),
+                                 persistent=False)
 
             # Init segment-wise transformer-based encoder
-            self.segment_encoder = nn.Transformer(d_model=self.hidden_size,
-                                                  nhead=config.num_attention_heads,
-                                                  batch_first=True, dim_feedforward=config.intermediate_size,
-                                                  activation=config.hidden_act,
-                                                  dropout=config.hidden_dropout_prob,
-                                                  layer_norm_eps=config.layer_norm_eps,
-                                                  num_encoder_layers=2, num_decoder_layers=0).encoder
+            # (same layout as the encoder of nn.Transformer, including the final layer norm)
+            segment_encoder_layer = nn.TransformerEncoderLayer(d_model=self.hidden_size,
+                                                               nhead=config.num_attention_heads,
+                                                               batch_first=True,
+                                                               dim_feedforward=config.intermediate_size,
+                                                               activation=config.hidden_act,
+                                                               dropout=config.hidden_dropout_prob,
+                                                               layer_norm_eps=config.layer_norm_eps,
+                                                               norm_first=config.segment_encoder_norm_first)
+            self.segment_encoder = nn.TransformerEncoder(segment_encoder_layer, num_layers=2,
+                                                         norm=nn.LayerNorm(self.hidden_size,
+                                                                           eps=config.layer_norm_eps))
+        else:
+            raise ValueError(f"Unknown segment_encoder_type '{self.segment_encoder_type}'. "
+                             "Use either 'lstm' or 'transformer'.")
+
+        # Only the small segment level part is compiled (see forward), the inner encoder sees a varying number of
+        # segments. Compiling encode_segments (not just the segment encoder) also fuses the positional embedding add
+        # and the pooling. Compilation is single-device only (see forward).
+        self.compile_segment_encoder = config.compile_segment_encoder and hasattr(torch, "compile")
+        if config.compile_segment_encoder and not self.compile_segment_encoder:
+            logger.warning("torch.compile requires PyTorch >= 2.0, the segment encoder is not compiled.")
 
         self.dropout = nn.Dropout(config.hidden_dropout_prob)
         self.classifier = nn.Linear(config.hidden_size, config.num_labels)
 
         self.init_weights()
 
+    def encoder_autocast(self, device):
+        """runs the inner and the segment encoder in bfloat16 if enabled, otherwise keeps the surrounding precision"""
+        if self.config.autocast_bf16:
+            return torch.autocast(device_type=device.type, dtype=torch.bfloat16)
+        return contextlib.nullcontext()
+
+    def encode_segments(self, encoder_outputs, seg_mask):
+        """encodes the segment representations (samples, segments, hidden) into a document representation"""
+        # segment_encoder_type is validated in __init__, so a single (constant) comparison suffices
+        if self.segment_encoder_type == 'lstm':
+            # LSTMs on top of segment encodings --> (16, 10, 1536)
+            lstms = self.segment_encoder(encoder_outputs)
+
+            # Reshape LSTM outputs to split directions -->  (16, 10, 2, 768)
+            reshaped_lstms = lstms[0].view(encoder_outputs.size(0), self.max_segments, 2, self.hidden_size)
+
+            # Down-project last forward and first backward hidden states -->  (16, 768)
+            # Equivalent to down_project on their concatenation (16, 1536), but without materializing it
+            forward_weight, backward_weight = self.down_project.weight.split(self.hidden_size, dim=1)
+            seg_encoder_outputs = nn.functional.linear(reshaped_lstms[:, -1, 0, :], forward_weight) + \
+                nn.functional.linear(reshaped_lstms[:, 0, 1, :], backward_weight, self.down_project.bias)
+
+        else:
+            # Transformer on top of segment encodings --> (16, 10, 768)
+            # Collect segment positional embeddings: segment i uses row i + 1, fake segments get zero vectors
+            # The positions are static, so slice the table directly instead of an index lookup per step
+            # The boolean mask is promoted within the multiplication, no separate cast needed
+            seg_pos_embeddings = self.seg_pos_embeddings[1:] * seg_mask.unsqueeze(-1)
+
+            # Add segment positional embeddings to segment inputs
+            encoder_outputs = encoder_outputs + seg_pos_embeddings
+
+            # Mask fake segments in the segment-wise attention and in the max-pooling below
+            seg_padding_mask = ~seg_mask
+
+            # Encode segments with segment-wise transformer (mask fake segments)
+            # With batch_first and a boolean (samples, segments) padding mask, PyTorch >= 2.0 dispatches the
+            # attention to the fused F.scaled_dot_product_attention kernels (and skips fake segments in eval)
+            seg_encoder_outputs = self.segment_encoder(encoder_outputs, src_key_padding_mask=seg_padding_mask)
+
+            # Collect document representation (ignore fake segments)
+            # amax does not compute the (unused) argmax indices
+            seg_encoder_outputs = seg_encoder_outputs.masked_fill(seg_padding_mask.unsqueeze(-1), float('-inf'))
+            seg_encoder_outputs = seg_encoder_outputs.amax(dim=1)
+
+        return seg_encoder_outputs
+
     @add_start_docstrings_to_model_forward(BERT_INPUTS_DOCSTRING.format("batch_size, sequence_length"))
     @add_code_sample_docstrings(
         tokenizer_class=_TOKENIZER_FOR_DOC,
@@ -84,73 +161,85 @@ class HierBertForSequenceClassification(ModelWithHeadsAdaptersMixin, BertPreTrai
             output_hidden_states=None,
             return_dict=None,
             adapter_names=None,
+            segment_mask=None,
     ):
         r"""
         labels (:obj:`torch.LongTensor` of shape :obj:`(batch_size,)`, `optional`):
             Labels for computing the sequence classification/regression loss. Indices should be in :obj:`[0, ...,
             config.num_labels - 1]`. If :obj:`config.num_labels == 1` a regression loss is computed (Mean-Square loss),
             If :obj:`config.num_labels > 1` a classification loss is computed (Cross-Entropy).
+        segment_mask (:obj:`torch.BoolTensor` of shape :obj:`(batch_size, max_segments)`, `optional`):
+            Mask of the real (not padded) segments. If not given, it is inferred from :obj:`input_ids`. The first
+            segment of each sample is always treated as real.
+
+        The inner encoder only runs on the real segments, so the returned :obj:`hidden_states` and :obj:`attentions`
+        (if requested) are of shape :obj:`(num_real_segments, max_segment_length, ...)`, with the real segments in
+        row-major (sample, segment) order, i.e., in the order of :obj:`segment_mask.nonzero()` (with the first segment
+        of each sample always counted as real).
         """
         return_dict = return_dict if return_dict is not None else self.config.use_return_dict
 
+        if segment_mask is not None:
+            # Real segments are already marked by the data collator --> (16, 10)
+            # Copy, so that keeping the first segment below does not modify the caller's mask
+            seg_mask = segment_mask.bool().clone()
+        else:
+            # Infer real segments, i.e., mask paddings (like attention_mask but on a segment level) --> (16, 10)
+            seg_mask = input_ids[:, :, 0] != self.config.pad_token_id
+        # Always keep the first segment, so that documents without any text still have one segment
+        # (a fully masked document would turn into NaNs in the segment-wise attention and the max-pooling)
+        seg_mask[:, 0] = True
+
         # Input (samples, segments, max_segment_length) --> (16, 10, 510)
         # Squash samples and segments into a single axis (samples * segments, max_segment_length) --> (160, 512)
-        input_ids_reshape = input_ids.contiguous().view(-1, input_ids.size(-1))
-        attention_mask_reshape = attention_mask.contiguous().view(-1, attention_mask.size(-1))
-        token_type_ids_reshape = token_type_ids.contiguous().view(-1, token_type_ids.size(-1))
-
-        outputs = self.bert(
-            input_ids_reshape,
-            attention_mask=attention_mask_reshape,
-            token_type_ids=token_type_ids_reshape,
-            position_ids=position_ids,
-            head_mask=head_mask,
-            inputs_embeds=inputs_embeds,
-            output_attentions=output_attentions,
-            output_hidden_states=output_hidden_states,
-            return_dict=return_dict,
-            adapter_names=adapter_names,
-        )
-
-        # TODO the outputs might have the wrong shape here
-        # in the original model it takes outputs[1]
-
-        encoder_outputs = outputs[0].contiguous().view(input_ids.size(0), self.max_segments,
-                                                       self.max_segment_length, self.hidden_size)
-
-        # Gather CLS per segment --> (16, 10, 768)
-        encoder_outputs = encoder_outputs[:, :, 0]
+        input_ids_reshape = input_ids.reshape(-1, input_ids.size(-1))
+        attention_mask_reshape = attention_mask.reshape(-1, attention_mask.size(-1))
+        token_type_ids_reshape = token_type_ids.reshape(-1, token_type_ids.size(-1))
 
-        if self.segment_encoder_type == 'lstm':
-            # LSTMs on top of segment encodings --> (16, 10, 1536)
-            lstms = self.segment_encoder(encoder_outputs)
-
-            # Reshape LSTM outputs to split directions -->  (16, 10, 2, 768)
-            reshaped_lstms = lstms[0].view(input_ids.size(0), self.max_segments, 2, self.hidden_size)
+        # Only encode real segments, fake segments are skipped (n_real_segments, max_segment_length) --> (97, 512)
+        real_segments = seg_mask.reshape(-1).nonzero(as_tuple=True)[0]
+        input_ids_reshape = input_ids_reshape.index_select(0, real_segments)
+        attention_mask_reshape = attention_mask_reshape.index_select(0, real_segments)
+        token_type_ids_reshape = token_type_ids_reshape.index_select(0, real_segments)
 
-            # Concatenate of first and last hidden states -->  (16, 1536)
-            seg_encoder_outputs = torch.cat((reshaped_lstms[:, -1, 0, :], reshaped_lstms[:, 0, 1, :]), -1)
+        with self.encoder_autocast(input_ids.device):
+            outputs = self.bert(
+                input_ids_reshape,
+                attention_mask=attention_mask_reshape,
+                token_type_ids=token_type_ids_reshape,
+                position_ids=position_ids,
+                head_mask=head_mask,
+                inputs_embeds=inputs_embeds,
+                output_attentions=output_attentions,
+                output_hidden_states=output_hidden_states,
+                return_dict=return_dict,
+                adapter_names=adapter_names,
+            )
 
-            # Down-project -->  (16, 768)
-            seg_encoder_outputs = self.down_project(seg_encoder_outputs)
+        # Gather CLS per real segment (97, 768) and scatter back to all segments, fake segments get zero vectors
+        # --> (16, 10, 768)
+        encoder_outputs = outputs[0].new_zeros(seg_mask.numel(), self.hidden_size)
+        encoder_outputs = encoder_outputs.index_copy(0, real_segments, outputs[0][:, 0])
+        encoder_outputs = encoder_outputs.view(input_ids.size(0), self.max_segments, self.hidden_size)
 
-        if self.segment_encoder_type == 'transformer':
-            # Transformer on top of segment encodings --> (16, 10, 768)
-            # Infer real segments, i.e., mask paddings (like attention_mask but on a segment level)
-            # seg_mask = (torch.sum(input_ids, 2) != self.config.pad_token_id).to(input_ids.dtype)
-            seg_mask = (input_ids[:, :, 0] != self.config.pad_token_id).to(input_ids.dtype)
-
-            # Infer and collect segment positional embeddings
-            seg_positions = torch.arange(1, self.max_segments + 1).to(input_ids.device) * seg_mask
-
-            # Add segment positional embeddings to segment inputs
-            encoder_outputs += self.seg_pos_embeddings(seg_positions)
+        # Only keep the (optional) hidden states and attentions of the inner encoder. No reference (not even a view)
+        # to its last hidden state (97, 512, 768) remains, so unless the hidden states are requested, it can be freed
+        # before the segment encoder runs (the backward of the CLS gather only needs the indices and shapes)
+        inner_outputs = (outputs.hidden_states, outputs.attentions) if return_dict else outputs[2:]
+        del outputs
 
-            # Encode segments with segment-wise transformer
-            seg_encoder_outputs = self.segment_encoder(encoder_outputs)
+        # Encode segments and collect document representation --> (16, 768)
+        with self.encoder_autocast(input_ids.device):
+            # nn.DataParallel creates new replicas on every forward, and the compiled function guards on the module
+            # object, so replicas would recompile each step until hitting the cache limit: run those eagerly
+            if self.compile_segment_encoder and not getattr(self, "_is_replica", False):
+                seg_encoder_outputs = compiled(type(self).encode_segments)(self, encoder_outputs, seg_mask)
+            else:
+                seg_encoder_outputs = self.encode_segments(encoder_outputs, seg_mask)
 
-            # Collect document representation
-            seg_encoder_outputs, _ = torch.max(seg_encoder_outputs, 1)
+        if self.config.autocast_bf16:
+            # Back to the precision of the classification head
+            seg_encoder_outputs = seg_encoder_outputs.to(self.classifier.weight.dtype)
 
         pooled_output = self.dropout(seg_encoder_outputs)
         logits = self.classifier(pooled_output)
@@ -179,12 +268,12 @@ class HierBertForSequenceClassification(ModelWithHeadsAdaptersMixin, BertPreTrai
                 loss = loss_fct(logits, labels)
 
         if not return_dict:
-            output = (logits,) + outputs[2:]
+            output = (logits,) + inner_outputs
             return ((loss,) + output) if loss is not None else output
 
         return SequenceClassifierOutput(
             loss=loss,
             logits=logits,
-            hidden_states=outputs.hidden_states,
-            attentions=outputs.attentions,
+            hidden_states=inner_outputs[0],
+            attentions=inner_outputs[1],
         )
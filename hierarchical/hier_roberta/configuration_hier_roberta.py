@@ -29,6 +29,16 @@ class HierRobertaConfig(RobertaConfig):
             than this will be truncated, sequences shorter will be padded.
         segment_encoder_type (:obj:`str`, `optional`, defaults to "transformer"):
             Whether to use a transformer or an lstm to encode the segment level representations.
+        segment_encoder_norm_first (:obj:`bool`, `optional`, defaults to :obj:`False`):
+            Whether the segment-wise transformer applies layer norm before (Pre-LN) instead of after (Post-LN) the
+            attention and feedforward blocks. Only used if :obj:`segment_encoder_type` is "transformer".
+        compile_segment_encoder (:obj:`bool`, `optional`, defaults to :obj:`False`):
+            Whether to compile the segment level part of the model (positional embeddings, segment encoder and
+            pooling) with :obj:`torch.compile` (requires PyTorch >= 2.0). Single-device only: replicas created by
+            :obj:`torch.nn.DataParallel` run eagerly.
+        autocast_bf16 (:obj:`bool`, `optional`, defaults to :obj:`False`):
+            Whether to run the inner encoder and the segment encoder under bfloat16 autocast. The segment positional
+            embeddings, the classification head and the loss stay in the surrounding precision.
     """
     model_type = "roberta"
 
@@ -37,6 +47,9 @@ class HierRobertaConfig(RobertaConfig):
             max_segments: Optional[int] = 4,
             max_segment_length: Optional[int] = 512,
             segment_encoder_type: Optional[str] = "transformer",
+            segment_encoder_norm_first: Optional[bool] = False,
+            compile_segment_encoder: Optional[bool] = False,
+            autocast_bf16: Optional[bool] = False,
             **kwargs
     ):
         super().__init__(**kwargs)
@@ -44,3 +57,6 @@ class HierRobertaConfig(RobertaConfig):
         self.max_segments = max_segments
         self.max_segment_length = max_segment_length
         self.segment_encoder_type = segment_encoder_type
+        self.segment_encoder_norm_first = segment_encoder_norm_first
+        self.compile_segment_encoder = compile_segment_encoder
+        self.autocast_bf16 = autocast_bf16
@@ -72,6 +72,7 @@ NUM_EPOCHS=10                       # high enough to be save, we use EarlyStoppi
 LABEL_IMBALANCE_METHOD=oversampling # this achieved the best results in our experiments
 SEG_TYPE=block                      # one of sentence, paragraph, block, overlapping
 OVERWRITE_CACHE=True                # IMPORTANT: Make sure to set this to true as soon as something with the data changes
+GRADIENT_CHECKPOINTING=False        # saves activation memory in HierBERT at ~30% extra compute, only worth it with larger batches
 
 # label smoothing cannot be used with a custom loss function
 # 0.1/0.2 seemed to be the best in the setting adapters-xlm-roberta-base-hierarchical de,fr to it
@@ -107,6 +108,11 @@ if [[ "$MODEL_NAME" =~ distilbert ]]; then
   BATCH_SIZE=$(($BATCH_SIZE * 2))
 fi
 
+# Gradient checkpointing (opt-in above) recomputes the activations of the inner encoder of HierBERT (samples * segments
+# inputs) in the backward pass. Only for hierarchical models and not with adapters: the output of the frozen embeddings
+# does not require grad, so the checkpointed layers (and thus the adapters) would not receive any gradients.
+[ "$MODEL_TYPE" != "hierarchical" ] || [ "$TRAIN_TYPE" == "adapters" ] && GRADIENT_CHECKPOINTING="False"
+
 # Compute variables based on settings above
 MODEL=$MODEL_NAME-$MODEL_TYPE
 RUN_DIR=$TRAIN_TYPE/$MODEL/$TRAIN_LANGUAGES/$SEED
@@ -160,6 +166,7 @@ CMD="python run_tc.py
   --save_strategy epoch
   --label_smoothing_factor $LABEL_SMOOTHING_FACTOR
   --label_imbalance_method $LABEL_IMBALANCE_METHOD
+  --gradient_checkpointing $GRADIENT_CHECKPOINTING
   --gradient_accumulation_steps $ACCUMULATION_STEPS
   --eval_accumulation_steps $ACCUMULATION_STEPS
   --per_device_train_batch_size $BATCH_SIZE
@@ -307,6 +307,8 @@ def main():
         max_segments=data_args.max_segments,
         max_segment_length=data_args.max_seg_len,
         segment_encoder_type="transformer",
+        compile_segment_encoder=model_args.compile_segment_encoder,
+        autocast_bf16=model_args.autocast_bf16,
     )
     tokenizer_class = AutoTokenizer
     if model_args.model_name_or_path == 'microsoft/Multilingual-MiniLM-L12-H384':
@@ -502,13 +504,16 @@ def main():
                     batch['segments'].append(sentences)
 
             # Tokenize the texts
-            tokenized = {'input_ids': [], 'attention_mask': [], 'token_type_ids': []}
+            tokenized = {'input_ids': [], 'attention_mask': [], 'token_type_ids': [], 'segment_mask': []}
             for case in batch['segments']:
                 case_encodings = tokenizer(case[:data_args.max_segments], padding=padding, truncation=True,
                                            max_length=data_args.max_seg_len, return_token_type_ids=True)
                 tokenized['input_ids'].append(append_zero_segments(case_encodings['input_ids'], pad_id))
                 tokenized['attention_mask'].append(append_zero_segments(case_encodings['attention_mask'], 0))
                 tokenized['token_type_ids'].append(append_zero_segments(case_encodings['token_type_ids'], 0))
+                # mark the real segments, so the model does not have to infer them (the first one is always kept)
+                num_segments = max(len(case_encodings['input_ids']), 1)
+                tokenized['segment_mask'].append([i < num_segments for i in range(data_args.max_segments)])
             del batch['segments']
         else:
             # Tokenize the texts
@@ -46,13 +46,15 @@ def preprocess_function(batch):
         """appends a list of zero segments to the encodings to make up for missing segments"""
         return case_encodings + [[pad_id] * max_seg_len] * (max_segments - len(case_encodings))
 
-    tokenized = {'input_ids': [], 'attention_mask': [], 'token_type_ids': []}
+    tokenized = {'input_ids': [], 'attention_mask': [], 'token_type_ids': [], 'segment_mask': []}
     for case in batch['segments']:
         case_encodings = tokenizer(case[:max_segments], padding=padding, truncation=True,
                                    max_length=max_seg_len, return_token_type_ids=True)
         tokenized['input_ids'].append(append_zero_segments(case_encodings['input_ids'], pad_id=config.pad_token_id))
         tokenized['attention_mask'].append(append_zero_segments(case_encodings['attention_mask'], pad_id=0))
         tokenized['token_type_ids'].append(append_zero_segments(case_encodings['token_type_ids'], pad_id=0))
+        num_segments = max(len(case_encodings['input_ids']), 1)
+        tokenized['segment_mask'].append([i < num_segments for i in range(max_segments)])
     del batch['segments']
 
     return tokenized
@@ -68,3 +70,11 @@ outputs = model(input_ids=torch.tensor(batch['input_ids'], device=device),
                 attention_mask=torch.tensor(batch['attention_mask'], device=device),
                 token_type_ids=torch.tensor(batch['token_type_ids'], device=device))
 print(outputs)
+
+# the segment mask from preprocessing has to give the same result as the one inferred from the input_ids
+outputs_with_segment_mask = model(input_ids=torch.tensor(batch['input_ids'], device=device),
+                                  attention_mask=torch.tensor(batch['attention_mask'], device=device),
+                                  token_type_ids=torch.tensor(batch['token_type_ids'], device=device),
+                                  segment_mask=torch.tensor(batch['segment_mask'], device=device))
+assert torch.allclose(outputs.logits, outputs_with_segment_mask.logits)
+print("provided and inferred segment masks give the same logits")